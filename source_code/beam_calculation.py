@@ -53,9 +53,10 @@ class Beam():
         Default value: 1
 
     center_x,y: integer
-        Coordinates of the beam center in sample plane, in pixels
+        Coordinates of the beam center in sample plane, in pixels.
+        Updated automatically when other attributes are changed.
 
-    beam_intensity: 2D numpy array
+    beam_intensity: 2D numpy array of float32
         Distribution of the beam intensity in sample plane (in pixels)
         to convolve it with the sample.
 
@@ -64,19 +65,28 @@ class Beam():
 
     convergence: float
         Beam convergence angle in radians
+
+    Any assignment to a public attribute marks the cached beam_intensity
+    as outdated, so it is recalculated only when beam parameters change.
     '''
 
     def __init__(self):
 
-        self.z_position = 15-np.random.random()*10
+        self._intensity_cache = None
+        self._dirty = True
+        self._initialized = False
+
+        rand = np.random.default_rng().random(5).tolist()
+
+        self.z_position = 15-rand[0]*10
 
         self.pixels_per_mm = 256/57.15*100
 
-        self.astigm_x = np.random.random()-0.5
-        self.astigm_y = np.random.random()-0.5
+        self.astigm_x = rand[1]-0.5
+        self.astigm_y = rand[2]-0.5
 
-        self.misalign_x = 0.4*np.random.random()-0.2
-        self.misalign_y = 0.4*np.random.random()-0.2
+        self.misalign_x = 0.4*rand[3]-0.2
+        self.misalign_y = 0.4*rand[4]-0.2
 
         self.focus = 0.1
         self.stigm_x = 0
@@ -87,71 +97,55 @@ class Beam():
         self.convergence = 0.01
         self.size = 64
 
-    @ property
-    def __defocus(self):
-        return self.focus - self.z_position
-
-    @ property
-    def center_x(self):
-        '''
-        Calculates beam center shift in x direction
+        self._initialized = True
+        self._update_derived()
 
-        Returns
-        -------
-        integer
-            Beam shift in pixels
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            self._dirty = True
+            if self._initialized:
+                self._update_derived()
 
+    def _update_derived(self):
         '''
-        c_x = int((self.align_x - self.misalign_x)*self.__defocus /
-                  self.focus*self.pixels_per_mm)
-        return min(abs(c_x), 96)*np.sign(c_x)
+        Recalculate defocus, beam widths, astigmatism angle and beam center
+        shift after any beam parameter was changed.
 
-    @ property
-    def center_y(self):
         '''
-        Calculates beam center shift in y direction
-
-        Returns
-        -------
-        integer
-            Beam shift in pixels
+        self._defocus = self.focus - self.z_position
 
-        '''
-        c_y = int((self.align_y - self.misalign_y)*self.__defocus /
+        c_x = int((self.align_x - self.misalign_x)*self._defocus /
                   self.focus*self.pixels_per_mm)
-        return min(abs(c_y), 49)*np.sign(c_y)
-
-    @ property
-    def __sigma2_x_mm(self):
-        return ((self.__defocus + abs(self.align_x - self.misalign_x)*10**-2
-                 + abs(self.stigm_x + self.astigm_x))
-                * self.convergence)**2 + 10**-16*(1 +
-                                                  100*self.beam_current)**3/4
-
-    @ property
-    def __sigma2_y_mm(self):
-        return ((self.__defocus + abs(self.align_y - self.misalign_y)*10**-2
-                 + abs(self.stigm_y + self.astigm_y))
-                * self.convergence)**2 + 10**-16*(1 +
-                                                  100*self.beam_current)**3/4
-
-    @ property
-    def __sigma2_x_px(self):
-        return self.__sigma2_x_mm*self.pixels_per_mm**2
-
-    @ property
-    def __sigma2_y_px(self):
-        return self.__sigma2_y_mm*self.pixels_per_mm**2
-
-    @ property
-    def __astig_angle(self):
-        return np.arctan((self.stigm_x + self.astigm_x
-                          )/(self.stigm_y + self.astigm_y))/2
+        c_y = int((self.align_y - self.misalign_y)*self._defocus /
+                  self.focus*self.pixels_per_mm)
+        # object.__setattr__ is used to avoid recursive update
+        object.__setattr__(self, 'center_x', min(abs(c_x), 96)*np.sign(c_x))
+        object.__setattr__(self, 'center_y', min(abs(c_y), 49)*np.sign(c_y))
+
+        self._sigma2_x_mm = ((self._defocus
+                              + abs(self.align_x - self.misalign_x)*10**-2
+                              + abs(self.stigm_x + self.astigm_x))
+                             * self.convergence)**2\
+            + 10**-16*(1 + 100*self.beam_current)**3/4
+        self._sigma2_y_mm = ((self._defocus
+                              + abs(self.align_y - self.misalign_y)*10**-2
+                              + abs(self.stigm_y + self.astigm_y))
+                             * self.convergence)**2\
+            + 10**-16*(1 + 100*self.beam_current)**3/4
+
+        self._sigma2_x_px = self._sigma2_x_mm*self.pixels_per_mm**2
+        self._sigma2_y_px = self._sigma2_y_mm*self.pixels_per_mm**2
+
+        self._astig_angle = np.arctan((self.stigm_x + self.astigm_x
+                                       )/(self.stigm_y + self.astigm_y))/2
 
     @ property
     def beam_intensity(self):
         '''
-        Distribution of the beam intensity in sample plane
+        Distribution of the beam intensity in sample plane.
+        It is calculated only if beam parameters were changed since
+        the previous call, otherwise the cached array is returned.
 
         Returns
         -------
@@ -159,36 +153,32 @@ class Beam():
             Beam intensity as a function of pixel number
 
         '''
-
-        def gauss(i, j):
-            '''
-            Parameters
-            ----------
-            i : integer
-                Y coordinate.
-            j : integer
-                X coordinate.
-
-            Returns
-            -------
-            gauss : float
-                Value of rotated 2D-gaussian in point with coordinates j,i.
-            '''
-            gauss = np.exp(-(j - self.size/2)**2*(
-                np.cos(self.__astig_angle)**2/self.__sigma2_x_px +
-                np.sin(self.__astig_angle)**2/self.__sigma2_y_px)
-                - (i - self.size/2)**2 *
-                (np.sin(self.__astig_angle)**2/self.__sigma2_x_px +
-                 np.cos(self.__astig_angle)**2/self.__sigma2_y_px) +
-                (i - self.size/2)*(j - self.size/2) *
-                np.sin(2*self.__astig_angle) *
-                (1/self.__sigma2_y_px - 1/self.__sigma2_x_px))
-
-            return gauss
-
-        raw_gauss = np.fromfunction(gauss, (self.size, self.size))
-        gauss_intensity = raw_gauss/raw_gauss.sum()
-
+        if not self._dirty and self._intensity_cache is not None:
+            return self._intensity_cache
+
+        angle = self._astig_angle
+        sigma2_x = self._sigma2_x_px
+        sigma2_y = self._sigma2_y_px
+        cos2 = np.cos(angle)**2
+        sin2 = np.sin(angle)**2
+        coef_x = cos2/sigma2_x + sin2/sigma2_y
+        coef_y = sin2/sigma2_x + cos2/sigma2_y
+        coef_xy = np.sin(2*angle)*(1/sigma2_y - 1/sigma2_x)
+
+        # exponent is a quadratic form of pixel coordinates relative to
+        # the kernel center, x - columns, y - rows
+        coords = np.arange(self.size) - self.size/2
+        x, y = np.meshgrid(coords, coords)
+        points = np.stack([x.ravel(), y.ravel()])
+        quad_form = np.array([[coef_x, -coef_xy/2],
+                              [-coef_xy/2, coef_y]])
+        exponent = np.einsum('ij,jk,ik->k', quad_form, points, points)
+
+        raw_gauss = np.exp(-exponent).reshape(self.size, self.size)
+        gauss_intensity = (raw_gauss/raw_gauss.sum()).astype(np.float32)
+
+        self._intensity_cache = gauss_intensity
+        self._dirty = False
         return gauss_intensity
 
     @ property
@@ -196,4 +186,4 @@ class Beam():
         '''
         Beam width in x and y direction, in nanometers
         '''
-        return (10**6*self.__sigma2_x_mm**0.5, 10**6*self.__sigma2_y_mm**0.5)
+        return (10**6*self._sigma2_x_mm**0.5, 10**6*self._sigma2_y_mm**0.5)
@@ -12,8 +12,11 @@
     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
     GNU General Public License for more details.
 '''
+import os
 import numpy as np
+from numba import njit, prange
 from PIL import Image
+from scipy.fft import rfft2, irfft2
 
 def image_open(path):
     '''
@@ -33,35 +36,128 @@ def image_open(path):
     '''
     img = np.asarray(Image.open(path))
     if len(img.shape) == 3:
-        rgb_weights = [0.2989, 0.5870, 0.1140]
-        img_grey = np.rint(np.dot(img[..., :3], rgb_weights)).astype(int)
+        # integer approximation of weights [0.2989, 0.5870, 0.1140]
+        rgb_weights = np.array([77, 150, 29], dtype=np.uint16)
+        img_grey = ((img[..., :3].astype(np.uint16)*rgb_weights).sum(
+            axis=-1, dtype=np.uint16) >> 8).astype(np.uint8)
     else:
         img_grey = img
     return img_grey
 
 
+def image_open_cached(path, cache_path):
+    '''
+    This function opens image file as 2D float32 numpy array, memory-mapped
+    from .npy file. The .npy file is created by image_open on first call
+    and recreated if the image file is newer.
+    If the .npy file can not be written or read, e.g. the folder is
+    read-only, the image is opened by image_open without caching.
+
+    Parameters
+    ----------
+    path : string
+        Path to image file.
+    cache_path : string
+        Path to .npy file with converted image.
+
+    Returns
+    -------
+    img_grey : 2D numpy memmap or array
+        Image with grayscale values.
 
-def convolution(image, kernel):
     '''
-    FFT-based convolution of two numpy arrays: image and kernel
+    try:
+        if (not os.path.exists(cache_path)
+                or os.path.getmtime(cache_path) < os.path.getmtime(path)):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            np.save(cache_path, image_open(path).astype(np.float32))
+        img_grey = np.load(cache_path, mmap_mode='r')
+    except (OSError, ValueError):
+        img_grey = image_open(path).astype(np.float32)
+    return img_grey
+
+
+def image_fft(image, fft_shape):
+    '''
+    Real FFT of an image for convolution_precomputed.
+    FFT is calculated using all available CPU cores.
 
     Parameters
     ----------
     image : 2D numpy array
-        Initial image to process.
+        Image to transform.
+    fft_shape : tuple
+        Shape of FFT, image is padded with zeros to this shape.
+
+    Returns
+    -------
+    f_image : 2D numpy array
+        Real FFT of the image in single precision.
+
+    '''
+    f_image = rfft2(image.astype(np.float32, copy=False), s=fft_shape,
+                    workers=-1)
+    return f_image
+
+
+def convolution_precomputed(f_image, kernel, fft_shape, window):
+    '''
+    FFT-based linear convolution of an image, given by its precomputed FFT,
+    and a kernel. FFTs are calculated using all available CPU cores.
+
+    Parameters
+    ----------
+    f_image : 2D numpy array
+        Real FFT of the image, calculated with shape fft_shape.
     kernel : 2D numpy array
-        Kernel to convolve initial image with it.
-        If its shape is not equal to the one of the image,
-        then it will be cropped or padded with zeros.
+        Kernel to convolve the image with it.
+    fft_shape : tuple
+        Shape of FFT, which should be not less than the sum of image
+        and kernel shapes to avoid circular wrap-around.
+    window : tuple
+        Two slices, defining the returned part of the convolution.
 
     Returns
     -------
     result : 2D numpy array
-        Resulting array after the convolution.
+        Part of the resulting array after the convolution.
+
+    '''
+
+    f_kernel = rfft2(kernel, s=fft_shape, workers=-1)
+    f_kernel *= f_image
+    result = irfft2(f_kernel, s=fft_shape, overwrite_x=True, workers=-1)
+    return result[window]
+
+
+# compiled on import for any layout of float32 arrays, and cached on disk,
+# so that the first scanning step does not wait for compilation
+@njit('void(float32[:, :], float32[:, :], float32[:, :], float64, float64,'
+      ' float64)', parallel=True, fastmath=True, cache=True)
+def blend_frame(frame_slice, conv_slice, noise, coeff, noise_coeff, add):
+    '''
+    Fill part of the frame in place with the signal from the convolution
+    and the noise in one pass, without temporary arrays:
+    frame_slice = coeff*conv_slice + noise_coeff*noise + add
+
+    Parameters
+    ----------
+    frame_slice : 2D numpy array
+        Part of the frame to be updated.
+    conv_slice : 2D numpy array
+        Part of the convolution of the same shape as frame_slice.
+    noise : 2D numpy array
+        Random noise of the same shape as frame_slice.
+    coeff : float
+        Signal gain.
+    noise_coeff : float
+        Noise gain.
+    add : float
+        Constant to be added.
 
     '''
 
-    f_1 = np.fft.rfft2(image)
-    f_2 = np.fft.rfft2(kernel, image.shape)
-    result = np.fft.irfft2(f_1*f_2)
-    return result
+    for i in prange(frame_slice.shape[0]):
+        for j in range(frame_slice.shape[1]):
+            frame_slice[i, j] = coeff*conv_slice[i, j] +\
+                noise_coeff*noise[i, j] + add
@@ -13,12 +13,21 @@
     GNU General Public License for more details.
 '''
 import os
+import random
 import numpy as np
+from scipy.fft import next_fast_len
 from PyQt5 import QtGui, QtCore, uic
 from PyQt5.QtWidgets import QFileDialog
 from pyqtgraph import ImageItem
 from beam_calculation import Beam
-from image_processing import convolution, image_open
+import image_processing
+from image_processing import blend_frame, image_open_cached
+try:
+    import microscope_gpu as fft_backend
+    from microscope_gpu import GPU_ERRORS
+except ImportError:
+    fft_backend = image_processing
+    GPU_ERRORS = ()
 
 
 class Microscope():
@@ -58,6 +67,22 @@ class Microscope():
         Dictionary, where keys are detectors and items are dictionaries,
         which in turn contains magnifications and images:
         {detector (string) : {magnification (integer) : image (numpy array)}.
+        Images are float32 arrays memory-mapped from .npy files.
+
+    image_pyramids: dict
+        Dictionary with the same structure as images, containing
+        dictionaries of images downsampled for each resolution available
+        in interface (by factors 1 and 2 for 512x384 and 256x192):
+        {detector : {magnification : {scale (integer) : image}}}.
+
+    image_ffts: dict
+        Dictionary with the same structure as images, containing tuples
+        (FFT, FFT shape) of images downsampled according to current
+        resolution. FFT shape is the image shape padded for linear
+        convolution with the beam.
+        If CuPy and CUDA device are available, FFTs are stored and
+        the convolution is calculated on GPU (see microscope_gpu module).
+        If GPU calculation fails, CPU is used until the program is closed.
 
     resolution: tuple
         Sequence of two integers, meaning number of pixels in image
@@ -153,9 +178,26 @@ class Microscope():
         self.mags = [1]
         self.curr_mag = 0
         self.images = {}
+        self.image_pyramids = {}
+        self.image_ffts = {}
+        # module with image_fft and convolution_precomputed functions
+        self._fft_backend = fft_backend
         self.screen_width = screen_width
         self.resolution = (256, 192)
-        self.frame = np.zeros(self.resolution)
+        self.frame = np.zeros(self.resolution, dtype=np.float32)
+        # noise for at most 11 lines of the frame, filled in place when
+        # scanning; lines go first to keep the filled part contiguous
+        self._rng = np.random.default_rng()
+        self._noise_buf = np.empty((11, self.resolution[0]), dtype=np.float32)
+        # image downsampling factor and shift of the convolution with
+        # respect to the image, as the beam is centered at size/2
+        self._scale = 512//self.resolution[0]
+        self._conv_offset = self.resolution[0]//8
+        # visible part of the convolution with the beam and the beam kernel
+        # and (detector, magnification) it was calculated for
+        self._conv_cache = None
+        self._conv_kernel = None
+        self._conv_image = None
         self.scan_active = False
         self.line = 0
         self.speed = 1
@@ -166,6 +208,12 @@ class Microscope():
         self.hv_target = hv_target
         self.h_v = 0
         self.beam = Beam()
+        # slider values at the last beam update, set when sample is loaded
+        self._beam_sliders = {}
+        # image gain and offset from contrast and brightness sliders,
+        # set from the sliders in create_interface
+        self._contrast_coef = 1
+        self._brightness = 0
 
         self.app = QtGui.QApplication([])
         self.window = None
@@ -225,22 +273,20 @@ class Microscope():
         self.user_interface.magnification_Slider.valueChanged.connect(
             self.magnification)
 
-        self.user_interface.beam_current_Slider.valueChanged.connect(
-            self.beam_current)
+        for slider in (self.user_interface.beam_current_Slider,
+                       self.user_interface.Focus_Slider,
+                       self.user_interface.stigmator_x_Slider,
+                       self.user_interface.stigmator_y_Slider,
+                       self.user_interface.alignment_x_Slider,
+                       self.user_interface.alignment_y_Slider):
+            slider.valueChanged.connect(self.__sync_beam)
 
-        self.user_interface.Focus_Slider.valueChanged.connect(self.focus)
+        self.user_interface.contrast_Slider.valueChanged.connect(self.contrast)
+        self.contrast()
 
-        self.user_interface.stigmator_x_Slider.valueChanged.connect(
-            self.stigm_x)
-
-        self.user_interface.stigmator_y_Slider.valueChanged.connect(
-            self.stigm_y)
-
-        self.user_interface.alignment_x_Slider.valueChanged.connect(
-            self.align_x)
-
-        self.user_interface.alignment_y_Slider.valueChanged.connect(
-            self.align_y)
+        self.user_interface.brightness_Slider.valueChanged.connect(
+            self.brightness)
+        self.brightness()
 
         self.user_interface.start_stop.clicked.connect(self.start_stop)
 
@@ -275,7 +321,10 @@ class Microscope():
         '''
         Read available detectors and update detectors in interface accoringly.
         Create dictionary with images for each detector as first key and
-        the magnification as the second key.
+        the magnification as the second key, and the same dictionary with
+        images downsampled for all supported resolutions.
+        Images are converted once and then loaded from .image_cache folder
+        next to Images folder.
 
         '''
         self.detectors = os.listdir(
@@ -285,18 +334,70 @@ class Microscope():
         self.user_interface.detector.setCurrentIndex(len(self.detectors)-1)
 
         self.beam = Beam()
+        # new beam keeps its own parameters until the sliders are moved
+        self._beam_sliders = self.__beam_slider_values()
+        # drop images of the previous sample
+        self.images = {}
+        self.image_pyramids = {}
+        self.image_ffts = {}
         if self.detectors:
             self.user_interface.start_stop.setEnabled(True)
             self.mags = sorted([int(x.split('.')[0]) for x in os.listdir(
                 f'{self.path_to_images}/Images/{self.sample}/{self.detectors[0]}')])
 
+            # downsampling factors for all resolutions available in interface
+            scales = {512//int(self.user_interface.resolution.itemText(i)
+                               .split('x')[0])
+                      for i in range(self.user_interface.resolution.count())}
+            scales.add(self._scale)
             for det in self.detectors:
-                self.images[det] = {m: image_open(
-                    f'{self.path_to_images}/Images/{self.sample}/{det}/{m}.tif')
+                self.images[det] = {m: image_open_cached(
+                    f'{self.path_to_images}/Images/{self.sample}/{det}/{m}.tif',
+                    f'{self.path_to_images}/.image_cache/{self.sample}/{det}/{m}.npy')
                     for m in self.mags}
+                self.image_pyramids[det] = {m: {
+                    scale: np.ascontiguousarray(image[::scale, ::scale])
+                    for scale in scales}
+                    for m, image in self.images[det].items()}
+            self.prepare_ffts()
         else:
             self.user_interface.start_stop.setEnabled(False)
 
+    def prepare_ffts(self):
+        '''
+        Calculate FFTs of all images downsampled according to current
+        resolution. Images do not change during scanning, so only the beam
+        has to be transformed on every scan step.
+
+        Images are transposed to have x coordinate first, like the frame.
+
+        '''
+        self._conv_cache = None
+        self.image_ffts = {}
+        for det in self.image_pyramids:
+            self.image_ffts[det] = {}
+            for m, pyramid in self.image_pyramids[det].items():
+                image = pyramid[self._scale].T
+                fft_shape = (
+                    next_fast_len(image.shape[0] + int(self.resolution[0]/4)),
+                    next_fast_len(image.shape[1] + int(self.resolution[0]/4)))
+                try:
+                    self.image_ffts[det][m] = (
+                        self._fft_backend.image_fft(image, fft_shape),
+                        fft_shape)
+                except GPU_ERRORS:
+                    self.__use_cpu()
+                    return
+
+    def __use_cpu(self):
+        '''
+        Switch FFT calculations from GPU to CPU after GPU error
+        and recalculate image FFTs.
+
+        '''
+        self._fft_backend = image_processing
+        self.prepare_ffts()
+
     def vent_pump(self):
         '''
         Start pumping or venting procedure.
@@ -330,7 +431,7 @@ class Microscope():
 
         '''
         if self.pressure > 1e-5:
-            self.pressure *= 0.5+0.5*np.random.rand()
+            self.pressure *= 0.5+0.5*random.random()
             self.user_interface.pressure.setText(str(format(self.pressure,
                                                             '.2e')) + ' Torr')
         else:
@@ -366,7 +467,7 @@ class Microscope():
 
         '''
         if self.h_v < self.hv_target:
-            self.h_v += np.random.rand()
+            self.h_v += random.random()
             self.beam.focus = max(0.1,
                                   self.user_interface.Focus_Slider.value()/1000 -
                                   self.hv_target + self.h_v)
@@ -398,8 +499,9 @@ class Microscope():
             img.save(file_name, 'PNG')
 
             pars = open(f'{file_name}_params.txt', 'w')
-            print(vars(self.beam), '\n', self.beam.beam_widths,
-                  file=pars)
+            beam_pars = {key: value for key, value in vars(self.beam).items()
+                         if not key.startswith('_')}
+            print(beam_pars, '\n', self.beam.beam_widths, file=pars)
             pars.close()
 
     def start_stop(self):
@@ -441,11 +543,15 @@ class Microscope():
         self.user_interface.screen.setRange(QtCore.QRectF(0, 0,
                                                           *self.resolution),
                                             padding=0)
-        self.frame = np.zeros(self.resolution)
+        self.frame = np.zeros(self.resolution, dtype=np.float32)
+        self._noise_buf = np.empty((11, self.resolution[0]), dtype=np.float32)
+        self._scale = 512//self.resolution[0]
+        self._conv_offset = self.resolution[0]//8
         self.img.setImage(self.frame)
         self.beam.size = int(self.resolution[0]/4)
         self.beam.pixels_per_mm = self.resolution[0]\
             * self.mags[self.curr_mag]/self.screen_width
+        self.prepare_ffts()
 
     def scan_speed(self):
         '''
@@ -461,7 +567,8 @@ class Microscope():
         and calculates the step for updating the part of the frame from line
         to line+step.
         The convolution of initial image with the beam_intensity of Beam
-        is calculated, and then part of this convolution, shifted according
+        is calculated from precomputed image FFT once per beam and image
+        change, and then part of this convolution, shifted according
         to beam.center coordinates, is used to update the part of the frame.
         This part of the frame is multiplied by the beam current and some
         random noise is added. The noise depends on beam current and scan speed.
@@ -472,43 +579,28 @@ class Microscope():
         '''
 
         det = self.user_interface.detector.currentText()
-        scale = int(512/self.resolution[0])
         step = (11 - self.speed)
-        if self.line < self.resolution[1] - 1 - step:
-
-            self.frame[:, self.line:self.line + step] = self.beam_on *\
-                self.h_v/self.hv_target *\
-                (convolution(self.images[det][self.mags[self.curr_mag]]
-                    [192 + self.beam.center_y: 576+128 + self.beam.center_y: scale,
-                     256 + self.beam.center_x: 768+128 + self.beam.center_x:scale],
-                    self.beam.beam_intensity).T
-                 [int(self.resolution[0]/8):int(9*self.resolution[0]/8),
-                 self.line + int(self.resolution[0]/8):
-                 self.line + int(self.resolution[0]/8) + step]
-                 * self.beam.beam_current
-                 + 10*self.beam.beam_current**0.5/self.speed**0.5
-                 * np.random.rand(self.resolution[0], step))\
-                * (self.user_interface.contrast_Slider.value()/30)**2\
-                + self.user_interface.brightness_Slider.value()-250
-
-            self.line += step
-
-        elif self.line < self.resolution[1] - 1:
-
-            self.frame[:, self.line:self.resolution[1]] = self.beam_on *\
-                self.h_v/self.hv_target *\
-                (convolution(self.images[det][self.mags[self.curr_mag]]
-                    [192 + self.beam.center_y: 576+128 + self.beam.center_y: scale,
-                     256 + self.beam.center_x: 768+128 + self.beam.center_x: scale],
-                    self.beam.beam_intensity).T
-                 [int(self.resolution[0]/8):int(9*self.resolution[0]/8),
-                 self.line + int(self.resolution[0]/8):
-                 self.resolution[1] + int(self.resolution[0]/8)]
-                 * self.beam.beam_current
-                 + 10*self.beam.beam_current**0.5/self.speed**0.5
-                 * np.random.rand(self.resolution[0], self.resolution[1]-self.line))\
-                * (self.user_interface.contrast_Slider.value()/30)**2\
-                + self.user_interface.brightness_Slider.value()-250
+        if self.line < self.resolution[1] - 1:
+
+            if self.line < self.resolution[1] - 1 - step:
+                end = self.line + step
+            else:
+                end = self.resolution[1]
+
+            # without the beam the signal is zero, and the frame is uniform
+            if not self.beam_on or self.h_v == 0 or self._contrast_coef == 0:
+                self.frame[:, self.line:end] = self._brightness
+            else:
+                conv = self.__visible_convolution(det)
+                noise = self._noise_buf[:end - self.line]
+                self._rng.random(out=noise, dtype=np.float32)
+                gain = self.beam_on*self.h_v/self.hv_target*self._contrast_coef
+                blend_frame(self.frame[:, self.line:end],
+                            conv[:, self.line:end],
+                            noise.T,
+                            gain*self.beam.beam_current,
+                            gain*10*self.beam.beam_current**0.5/self.speed**0.5,
+                            self._brightness)
 
             self.line += step
         else:
@@ -516,6 +608,45 @@ class Microscope():
 
         self.img.setImage(self.frame, autoLevels=False, levels=(0, 255))
 
+    def __visible_convolution(self, det):
+        '''
+        Convolution of the image from detector det at current magnification
+        with the beam, cropped to the visible area and shifted according to
+        beam.center coordinates. It is recalculated only when the detector,
+        magnification or any beam parameter is changed, otherwise the result
+        from previous scan step is used.
+
+        Returns
+        -------
+        2D numpy array
+            Visible part of the convolution, oriented as the frame.
+
+        '''
+        mag = self.mags[self.curr_mag]
+        kernel = self.beam.beam_intensity
+        # beam_intensity returns the same array while the beam is unchanged
+        if (self._conv_cache is None or kernel is not self._conv_kernel
+                or self._conv_image != (det, mag)):
+            row = (192 + self.beam.center_y)//self._scale + self._conv_offset
+            col = (256 + self.beam.center_x)//self._scale + self._conv_offset
+            window = (slice(col, col + self.resolution[0]),
+                      slice(row, row + self.resolution[1]))
+            # image FFTs are transposed, so the kernel is transposed as well
+            try:
+                f_image, fft_shape = self.image_ffts[det][mag]
+                conv = self._fft_backend.convolution_precomputed(
+                    f_image, kernel.T, fft_shape, window)
+            except GPU_ERRORS:
+                self.__use_cpu()
+                f_image, fft_shape = self.image_ffts[det][mag]
+                conv = self._fft_backend.convolution_precomputed(
+                    f_image, kernel.T, fft_shape, window)
+            self._conv_cache = conv
+            self._conv_kernel = kernel
+            self._conv_image = (det, mag)
+
+        return self._conv_cache
+
     def wobble(self):
         '''
         Turn on or off wobble of miroscope focus.
@@ -545,50 +676,51 @@ class Microscope():
 
         self.wobble_time += 1
 
-    def focus(self):
-        '''
-        Update beam focus from focus slider and update datazone.
-
-        '''
-        self.beam.focus = self.user_interface.Focus_Slider.value()/1000
-        self.update_datazone()
-
-    def stigm_x(self):
+    def __beam_slider_values(self):
         '''
-        Update beam stigm_x parameter from stigmator x slider.
+        Beam parameters corresponding to current positions of focus,
+        stigmator, alignment and beam current sliders.
 
-        '''
-        self.beam.stigm_x = self.user_interface.stigmator_x_Slider.value()/1000
-
-    def stigm_y(self):
-        '''
-        Update beam stigm_y parameter from stigmator y slider.
+        Returns
+        -------
+        dict
+            Beam attribute names and their values.
 
         '''
-        self.beam.stigm_y = self.user_interface.stigmator_y_Slider.value()/1000
+        return {
+            'focus': self.user_interface.Focus_Slider.value()/1000,
+            'stigm_x': self.user_interface.stigmator_x_Slider.value()/1000,
+            'stigm_y': self.user_interface.stigmator_y_Slider.value()/1000,
+            'align_x': self.user_interface.alignment_x_Slider.value()/200,
+            'align_y': self.user_interface.alignment_y_Slider.value()/200,
+            'beam_current': self.user_interface.beam_current_Slider.value()/100}
 
-    def align_x(self):
+    def __sync_beam(self):
         '''
-        Update beam align_x parameter from alignment x slider.
+        Update beam focus, stigmator, alignment and beam current from their
+        sliders and update datazone. Only parameters, whose sliders were
+        changed since the previous call, are assigned to the beam.
 
         '''
-        self.beam.align_x = self.user_interface.alignment_x_Slider.value()/200
+        for name, value in self.__beam_slider_values().items():
+            if self._beam_sliders[name] != value:
+                self._beam_sliders[name] = value
+                setattr(self.beam, name, value)
+        self.update_datazone()
 
-    def align_y(self):
+    def contrast(self):
         '''
-        Update beam align_y parameter from alignment y slider.
+        Update image gain from contrast slider.
 
         '''
-        self.beam.align_y = self.user_interface.alignment_y_Slider.value()/200
+        self._contrast_coef = (self.user_interface.contrast_Slider.value()/30)**2
 
-    def beam_current(self):
+    def brightness(self):
         '''
-        Update beam current from beam current slider and update datazone.
+        Update image offset from brightness slider.
 
         '''
-        self.beam.beam_current =\
-            self.user_interface.beam_current_Slider.value()/100
-        self.update_datazone()
+        self._brightness = self.user_interface.brightness_Slider.value() - 250
 
     def update_datazone(self):
         '''
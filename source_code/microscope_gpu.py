@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+    Copyright (C) 2021  Yuri Petrov
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    GPU versions of image_processing functions, used by microscope module
+    instead of CPU ones if CuPy is installed and CUDA device is available.
+    Otherwise ImportError is raised on import.
+'''
+import cupy as cp
+from cupy.cuda.cufft import CuFFTError
+from cupyx.scipy.fft import rfft2, irfft2
+
+try:
+    if cp.cuda.runtime.getDeviceCount() == 0:
+        raise ImportError('No CUDA device found')
+except cp.cuda.runtime.CUDARuntimeError as error:
+    raise ImportError('CUDA is not available') from error
+
+# errors of GPU calculations, after which CPU functions should be used
+GPU_ERRORS = (cp.cuda.runtime.CUDARuntimeError, cp.cuda.driver.CUDADriverError,
+              cp.cuda.memory.OutOfMemoryError, CuFFTError)
+
+
+def image_fft(image, fft_shape):
+    '''
+    Real FFT of an image for convolution_precomputed.
+    The image is copied to GPU memory, and the FFT is kept there.
+
+    Parameters
+    ----------
+    image : 2D numpy array
+        Image to transform.
+    fft_shape : tuple
+        Shape of FFT, image is padded with zeros to this shape.
+
+    Returns
+    -------
+    f_image : 2D cupy array
+        Real FFT of the image in single precision.
+
+    '''
+    f_image = rfft2(cp.asarray(image, dtype=cp.float32), s=fft_shape)
+    return f_image
+
+
+def convolution_precomputed(f_image, kernel, fft_shape, window):
+    '''
+    FFT-based linear convolution of an image, given by its precomputed FFT
+    in GPU memory, and a kernel. Only the window of the result is copied
+    back from GPU.
+
+    Parameters
+    ----------
+    f_image : 2D cupy array
+        Real FFT of the image, calculated with shape fft_shape.
+    kernel : 2D numpy array
+        Kernel to convolve the image with it.
+    fft_shape : tuple
+        Shape of FFT, which should be not less than the sum of image
+        and kernel shapes to avoid circular wrap-around.
+    window : tuple
+        Two slices, defining the returned part of the convolution.
+
+    Returns
+    -------
+    result : 2D numpy array
+        Part of the resulting array after the convolution.
+
+    '''
+
+    f_kernel = rfft2(cp.asarray(kernel), s=fft_shape)
+    f_kernel *= f_image
+    result = irfft2(f_kernel, s=fft_shape, overwrite_x=True)
+    return cp.asnumpy(result[window])